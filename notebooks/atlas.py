@@ -21,19 +21,68 @@ import pandas, numpy, os, json, anndata
 from sklearn.decomposition import PCA
 from copy import deepcopy   # For nested dictionaries, we need deepcopy, otherwise values are just references
 
-def rankTransform(df):
-    """Return a rank transformed version of data frame
+CACHE_VERSION = 1   # increment this when the layout of the binary cache changes, so that older caches are rebuilt
+CACHE_SOURCES = ['expression', 'genes', 'samples']  # source files the binary cache is built from
+
+def rankArray(values, out=None, dtype=numpy.float64, n_jobs=None, blockSize=256):
+    """Return ranks of each column of values (2d numpy array) in descending order, with the same semantics as
+    DataFrame.rank(axis=0, ascending=False, na_option='bottom'): tied values get the average of their ranks, and NaNs
+    are ranked last, tied with each other. Ranks are written into out if specified (same shape as values), otherwise
+    into a new array of dtype. Columns are ranked in blocks of blockSize using argsort, in parallel over n_jobs threads
+    (all cpus if None) - numpy releases the GIL while sorting.
     """
-    return (df.shape[0] - df.rank(axis=0, ascending=False, na_option='bottom')+1)/df.shape[0]
+    values = numpy.asarray(values)
+    if out is None:
+        out = numpy.empty(values.shape, dtype=dtype)
+    if values.shape[0]==0:
+        return out
+
+    positions = numpy.arange(values.shape[0])
+    lastPosition = values.shape[0] - 1
+    def rankBlock(start):
+        # Work on a contiguous copy of the block with columns as rows, negated for descending order
+        block = numpy.negative(values[:,start:start+blockSize].transpose(), dtype=numpy.float64, order='C')
+        order = numpy.argsort(block, axis=1)  # NaNs are sorted to the end
+        block = numpy.take_along_axis(block, order, axis=1)
+
+        # Find first and last sorted position of each group of tied values, then each value gets the average rank of its group
+        isNan = numpy.isnan(block)
+        newGroup = numpy.ones(block.shape, dtype=bool)
+        newGroup[:,1:] = (block[:,1:]!=block[:,:-1]) & ~(isNan[:,1:] & isNan[:,:-1])
+        endGroup = numpy.ones(block.shape, dtype=bool)
+        endGroup[:,:-1] = newGroup[:,1:]
+        first = numpy.maximum.accumulate(numpy.where(newGroup, positions, 0), axis=1)
+        last = numpy.minimum.accumulate(numpy.where(endGroup, positions, lastPosition)[:,::-1], axis=1)[:,::-1]
+        ranks = numpy.empty(block.shape, dtype=out.dtype)
+        numpy.put_along_axis(ranks, order, (first + last)/2 + 1, axis=1)
+        out[:,start:start+blockSize] = ranks.transpose()
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as executor:
+        list(executor.map(rankBlock, range(0, values.shape[1], blockSize)))
+    return out
+
+def rankTransform(df, dtype=numpy.float64, n_jobs=None):
+    """Return a rank transformed version of data frame, where each value becomes (n - rank + 1)/n for n rows of df
+    and rank calculated by rankArray (highest value of each column gets 1). dtype can be numpy.float32 to halve memory.
+    """
+    n = df.shape[0]
+    values = rankArray(df.values, dtype=dtype, n_jobs=n_jobs)
+    values -= n + 1
+    values /= -n
+    return pandas.DataFrame(values, index=df.index, columns=df.columns)
 
 def filepaths(pathToAtlasData, atlasType):
     """Return a dictionary of full filepaths to each key.
     Example: filenames('/Users/jarnyc/projects/atlas','blood') will return
         {"expression":"/Users/jarnyc/projects/atlas/blood_atlas_expression_v7.1.tsv", ...}
     Note that this function takes version numbers into account and will return the latest version of the file in the directory.
+    The "cache" key points to the binary cache directory of this atlas (see writeCache), but only if it exists and 
+    is still valid for the current source files - otherwise it is None.
     """
     paths = {'expression':None, 'genes':None, 'samples':None, 'colours':None}
-    allFilenames = [filename for filename in os.listdir(pathToAtlasData) if filename.startswith(atlasType)]
+    allFilenames = [filename for filename in os.listdir(pathToAtlasData) if filename.startswith(atlasType) and 
+                    os.path.isfile(os.path.join(pathToAtlasData, filename))]
     for key in paths.keys():
         matchingFilenames = [filename for filename in allFilenames if key in filename]
         
@@ -45,83 +94,645 @@ def filepaths(pathToAtlasData, atlasType):
             paths[key] = os.path.join(pathToAtlasData, matchingFilenames[0])
         else:
             pass # work out how to deal with multiple files matching this key (possibly due to multiple versions)
+
+    cache = cachePath(pathToAtlasData, atlasType)
+    paths['cache'] = cache if isCacheValid(cache, paths) else None
     return paths
 
-def create_atlas(expressionDatafile, sampleDatafile):
+def cachePath(pathToAtlasData, atlasType):
+    """Return the full path to the binary cache directory for this atlas type, eg. /path/to/atlas/blood_cache.
+    """
+    return os.path.join(pathToAtlasData, "%s_cache" % atlasType)
+
+def fileSignature(filepath):
+    """Return a dictionary of size and modification time of filepath, which is how we decide if a cache is out of date.
+    """
+    stat = os.stat(filepath)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def cacheLibraries():
+    """Return versions of the libraries that wrote the cache - pickled tables may not load under other versions.
+    """
+    return {"numpy": numpy.__version__, "pandas": pandas.__version__}
+
+def isCacheValid(cache, paths):
+    """Return True if the cache directory exists and was built from source files matching the current ones in paths.
+    """
+    manifestFile = os.path.join(cache, "manifest.json")
+    if not os.path.exists(manifestFile) or any(paths.get(key) is None for key in CACHE_SOURCES):
+        return False
+    with open(manifestFile) as f:
+        manifest = json.load(f)
+    return manifest.get("version")==CACHE_VERSION and manifest.get("libraries")==cacheLibraries() and \
+        manifest.get("sources")=={key: fileSignature(paths[key]) for key in CACHE_SOURCES}
+
+def orderedValues(df, genes, samples, genePositions=None):
+    """Return numpy array of expression (samples x genes) from df (genes x samples), in the order of samples.index and 
+    genes.index. If genePositions is specified, only those positions of genes.index are returned. Only the selected rows
+    of df are gathered, rather than reordering a copy of the whole of df first.
+    """
+    rows = df.index.get_indexer(genes.index)
+    if genePositions is not None:
+        rows = rows[genePositions]
+    return df.values[numpy.ix_(rows, df.columns.get_indexer(samples.index))].transpose()
+
+def writeCache(cache, paths, df, genes, samples, blockSize=2000):
+    """Write the binary cache of the atlas to cache directory.
+    df is the DataFrame of expression (genes x samples) as read from the text file. It is written as a numpy array of 
+    samples x genes in the order of samples.index and genes.index, blockSize genes at a time to bound the extra memory used.
+    The cache is written into a new temporary directory next to cache, which then replaces cache (with any arrays 
+    derived from an older version of the source files) by renaming, so that several processes writing the cache at the
+    same time never see each other's partial files. If another process has already put a valid cache in place by the
+    time this one is done, that cache is kept.
+    """
+    import tempfile, shutil
+    parent = os.path.dirname(os.path.abspath(cache))
+    tempCache = tempfile.mkdtemp(prefix=os.path.basename(cache) + ".", suffix=".tmp", dir=parent)
+    try:
+        values = numpy.lib.format.open_memmap(os.path.join(tempCache, "expression.npy"), mode="w+", dtype=numpy.float64, 
+                                              shape=(len(samples), len(genes)))
+        for start in range(0, len(genes), blockSize):
+            values[:, start:start+blockSize] = orderedValues(df, genes, samples, numpy.arange(start, min(start+blockSize, len(genes))))
+        values.flush()
+        del values
+        genes.to_pickle(os.path.join(tempCache, "genes.pkl"))
+        samples.to_pickle(os.path.join(tempCache, "samples.pkl"))
+        with open(os.path.join(tempCache, "manifest.json"), "w") as f:
+            json.dump({"version": CACHE_VERSION, "libraries": cacheLibraries(), 
+                       "sources": {key: fileSignature(paths[key]) for key in CACHE_SOURCES}}, f, indent=2)
+
+        if isCacheValid(cache, paths):  # another process finished first
+            return
+        os.chmod(tempCache, 0o755)  # mkdtemp makes it private to this user
+        oldCache = tempCache + ".old"
+        try:
+            os.replace(cache, oldCache)
+        except FileNotFoundError:  # no cache yet, or another process has just moved it
+            pass
+        try:
+            os.replace(tempCache, cache)
+        except OSError:
+            if not isCacheValid(cache, paths):  # not because another process has just put a valid cache in place
+                raise
+        shutil.rmtree(oldCache, ignore_errors=True)
+    finally:
+        shutil.rmtree(tempCache, ignore_errors=True)
+
+def readCache(cache, mmap_mode=None):
+    """Return (values, genes, samples) from cache directory, where values is the numpy array of expression (samples x genes).
+    mmap_mode is passed onto numpy.load, so use mmap_mode='r' to memory-map values rather than reading it into memory.
+    """
+    values = numpy.load(os.path.join(cache, "expression.npy"), mmap_mode=mmap_mode)
+    genes = pandas.read_pickle(os.path.join(cache, "genes.pkl"))
+    samples = pandas.read_pickle(os.path.join(cache, "samples.pkl"))
+    return values, genes, samples
+
+def cachedArray(cache, name, dtype, shape, build, blockSize=1000):
+    """Return the array called name of dtype and shape from cache directory, memory-mapped read-only.
+    If it is not in the cache yet, it is written there first, blockSize rows at a time: build(rows) is called with a 
+    slice of rows and returns the values of those rows, so the whole array is never held in memory.
+    The file is written under a temporary name and then renamed, so that other processes never see a partial file.
+    """
+    filepath = os.path.join(cache, "%s_%s.npy" % (name, numpy.dtype(dtype).name))
+    if not os.path.exists(filepath):
+        tempFile = "%s.%s.tmp.npy" % (filepath[:-4], os.getpid())
+        values = numpy.lib.format.open_memmap(tempFile, mode="w+", dtype=dtype, shape=shape)
+        for start in range(0, shape[0], blockSize):
+            values[start:start+blockSize] = build(slice(start, start+blockSize))
+        values.flush()
+        del values
+        os.replace(tempFile, filepath)
+    return numpy.load(filepath, mmap_mode='r')
+
+class LazyDict(dict):
+    """A dictionary where values of some keys are only built when they are first accessed.
+    builders is a dictionary of functions, keyed on the same keys, which return the value for that key. Once built, 
+    the value is kept in the dictionary like any other value. Note that "key in d" and d.get(key) are False and None for
+    a key that has not been built yet, since they do not trigger building.
+        > d = LazyDict({"filtered": lambda: expensiveCalculation()})
+        > d["filtered"]  # expensiveCalculation() is run here
+    """
+    def __init__(self, builders):
+        super().__init__()
+        self.builders = builders
+
+    def __missing__(self, key):
+        if key not in self.builders:
+            raise KeyError(key)
+        self[key] = self.builders[key]()
+        return super().__getitem__(key)
+
+class RankMatrix(object):
+    """Compact storage of a rank transformed matrix (samples x genes), ie. the transpose of what rankTransform returns.
+    Each value (n - r + 1)/n, where r is the rank of the gene within its sample (a multiple of 0.5, since ties get the 
+    average rank) and n is the number of genes, is stored as the integer code 2*(n - r + 1). Codes are uint16 if they 
+    fit, otherwise uint32, so this is 4 times smaller than float64. On disk this is just the .npy file of codes (see 
+    save and load), since n is the number of columns. Use decode() or blocks() to get float values back.
+        > ranks = RankMatrix.fromExpression(values)  # values is numpy array of samples x genes
+        > ranks.decode(rows=slice(0,100))  # float32 array of rank transformed values for the first 100 samples
+    """
+    def __init__(self, codes, n=None):
+        self.codes = codes
+        self.n = codes.shape[1] if n is None else n
+
+    @staticmethod
+    def codeType(n):
+        """Return the smallest unsigned integer type which can hold codes for n genes.
+        """
+        return numpy.uint16 if 2*n<=numpy.iinfo(numpy.uint16).max else numpy.uint32
+
+    @classmethod
+    def fromExpression(cls, values, blockSize=1000, n_jobs=None):
+        """Return RankMatrix of values (samples x genes numpy array), ranking genes within each sample as rankTransform 
+        does. This is done blockSize samples at a time, so only a block is ever held as floats.
+        """
+        n = values.shape[1]
+        codes = numpy.empty(values.shape, dtype=cls.codeType(n))
+        for start in range(0, values.shape[0], blockSize):
+            ranks = rankArray(values[start:start+blockSize].transpose(), n_jobs=n_jobs)
+            codes[start:start+blockSize] = (2*(n + 1) - 2*ranks).transpose()
+        return cls(codes, n)
+
+    @classmethod
+    def load(cls, filepath, mmap_mode='r'):
+        return cls(numpy.load(filepath, mmap_mode=mmap_mode))
+
+    def save(self, filepath):
+        numpy.save(filepath, self.codes)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def decode(self, rows=slice(None), columns=slice(None), dtype=numpy.float32):
+        """Return numpy array of rank transformed values for the selected rows (samples) and columns (genes).
+        """
+        return numpy.divide(self.codes[rows][:,columns], 2*self.n, dtype=dtype)
+
+    def blocks(self, blockSize=1000, dtype=numpy.float32):
+        """Generator of (start, values) for blocks of blockSize rows, where values is the decoded block.
+        """
+        for start in range(0, self.shape[0], blockSize):
+            yield start, self.decode(rows=slice(start, start+blockSize), dtype=dtype)
+
+    def concatenate(self, other):
+        """Return a new RankMatrix with rows of other appended to rows of this one. Both must be ranked over the same genes.
+        """
+        if other.n!=self.n or other.shape[1]!=self.shape[1]:
+            raise Exception("RankMatrix objects to concatenate must have the same genes")
+        codeType = numpy.promote_types(self.codes.dtype, other.codes.dtype)
+        return RankMatrix(numpy.concatenate([self.codes.astype(codeType, copy=False), other.codes.astype(codeType, copy=False)]), self.n)
+
+class PCAModel(object):
+    """Fitted PCA, with the attributes and transform() method of sklearn.decomposition.PCA which this module uses 
+    (components_, mean_, explained_variance_, explained_variance_ratio_), so it can be used in its place.
+    transform() also accepts a RankMatrix, which is decoded in blocks.
+    """
+    def __init__(self, components, mean, explainedVariance, explainedVarianceRatio):
+        self.components_ = components
+        self.mean_ = mean
+        self.explained_variance_ = explainedVariance
+        self.explained_variance_ratio_ = explainedVarianceRatio
+        self.n_components_ = len(explainedVariance)
+
+    @classmethod
+    def fromSklearn(cls, pca):
+        """Return PCAModel with the same fit as pca, a fitted sklearn.decomposition.PCA object.
+        """
+        return cls(pca.components_, pca.mean_, pca.explained_variance_, pca.explained_variance_ratio_)
+
+    @classmethod
+    def load(cls, filepath):
+        """Return (model, coordinates) saved by save().
+        """
+        with numpy.load(filepath) as data:
+            return cls(data["components"], data["mean"], data["explainedVariance"], data["explainedVarianceRatio"]), data["coords"]
+
+    def save(self, filepath, coords):
+        """Save this model and the coordinates of the samples it was fitted to as a .npz file.
+        """
+        numpy.savez(filepath, components=self.components_, mean=self.mean_, explainedVariance=self.explained_variance_,
+                    explainedVarianceRatio=self.explained_variance_ratio_, coords=coords)
+
+    @classmethod
+    def fitGram(cls, X, n_components=10, blockSize=2000):
+        """Fit PCA to X (samples x genes) by eigen decomposition of the samples x samples Gram matrix of centred X, which 
+        is much cheaper than a full SVD when there are fewer samples than genes. X can be a numpy array or a RankMatrix. 
+        Only blockSize genes of X are decoded as floats at a time. Returns (model, coordinates of X).
+        """
+        def columns(start):
+            if isinstance(X, RankMatrix):
+                return X.decode(columns=slice(start, start+blockSize), dtype=numpy.float64)
+            return numpy.asarray(X[:,start:start+blockSize], dtype=numpy.float64)
+
+        nSamples, nGenes = X.shape
+        n_components = min(n_components, nSamples, nGenes)
+        mean = numpy.empty(nGenes)
+        gram = numpy.zeros((nSamples, nSamples))
+        for start in range(0, nGenes, blockSize):
+            block = columns(start)
+            mean[start:start+blockSize] = block.mean(axis=0)
+            block -= mean[start:start+blockSize]
+            gram += block @ block.transpose()
+
+        eigenvalues, eigenvectors = numpy.linalg.eigh(gram)
+        eigenvalues = numpy.clip(eigenvalues[::-1][:n_components], 0, None)
+        eigenvectors = eigenvectors[:,::-1][:,:n_components]
+        eigenvectors *= numpy.sign(eigenvectors[numpy.abs(eigenvectors).argmax(axis=0), range(n_components)])  # same signs as sklearn
+        singularValues = numpy.sqrt(eigenvalues)
+
+        # components are the right singular vectors, calculated from the left ones
+        components = numpy.empty((n_components, nGenes))
+        scale = numpy.divide(1, singularValues, out=numpy.zeros(n_components), where=singularValues>0)
+        for start in range(0, nGenes, blockSize):
+            block = columns(start) - mean[start:start+blockSize]
+            components[:,start:start+blockSize] = (block.transpose() @ eigenvectors * scale).transpose()
+
+        model = cls(components, mean, eigenvalues/max(nSamples - 1, 1), eigenvalues/numpy.trace(gram))
+        return model, eigenvectors * singularValues
+
+    @classmethod
+    def fitIncremental(cls, X, n_components=10, maxMemory=512*1024**2):
+        """Fit PCA to X (samples x genes) with sklearn's IncrementalPCA, streaming blocks of samples from X, which can be
+        a memory-mapped numpy array or a RankMatrix, so X never needs to fit in memory. Blocks are sized so that the
+        memory used for fitting stays around maxMemory bytes (but at least n_components samples are in each block).
+        Returns (model, coordinates of X).
+        """
+        from sklearn.decomposition import IncrementalPCA
+        from sklearn.utils import gen_batches
+        def rows(batch):
+            if isinstance(X, RankMatrix):
+                return X.decode(rows=batch, dtype=numpy.float64)
+            return numpy.asarray(X[batch], dtype=numpy.float64)
+
+        # IncrementalPCA holds about 4 arrays of the block size while fitting each block. A last block with fewer than
+        # n_components samples is too small to fit on its own, so it is merged into the previous one.
+        blockSize = max(n_components, int(maxMemory/(4*8*X.shape[1])))
+        batches = list(gen_batches(X.shape[0], blockSize, min_batch_size=n_components))
+        pca = IncrementalPCA(n_components=n_components)
+        for batch in batches:
+            pca.partial_fit(rows(batch))
+        model = cls.fromSklearn(pca)
+        return model, numpy.vstack([model.transform(rows(batch)) for batch in batches])
+
+    def transform(self, X):
+        if isinstance(X, RankMatrix):
+            return numpy.vstack([self.transform(block) for start,block in X.blocks(dtype=numpy.float64)])
+        return (numpy.asarray(X) - self.mean_) @ self.components_.transpose()
+
+def squaredDistances(X, Y):
+    """Return matrix of squared euclidean distances between rows of X and rows of Y.
+    """
+    distances = (X**2).sum(axis=1)[:,None] - 2*X.dot(Y.T) + (Y**2).sum(axis=1)[None,:]
+    return numpy.maximum(distances, 0, out=distances)
+
+class IVFIndex(object):
+    """Approximate nearest neighbour index (inverted file index), with the query() method of sklearn.neighbors.KDTree
+    which this module uses, so it can be used in its place.
+    Points are clustered by k-means into nLists lists. A query only searches the points in the nProbe lists with the 
+    nearest centroids, so it scales with nProbe/nLists of the points, rather than all of them. Increase nProbe for 
+    higher recall at the cost of speed (nProbe=nLists is exact). See benchmarkNeighbourIndex for recall vs speed.
+        > index = IVFIndex.build(atl.coords["filtered"].values)
+        > distances, indices = index.query(coords, k=10, nProbe=8)
+    """
+    def __init__(self, centroids, offsets, ids, points):
+        self.centroids = centroids  # nLists x dimensions
+        self.offsets = offsets      # points of list i are points[offsets[i]:offsets[i+1]]
+        self.ids = ids              # positions of points in the original array, as returned by query()
+        self.points = points        # points sorted by list
+        self.nLists = len(centroids)
+
+    @classmethod
+    def build(cls, points, nLists=None, nIter=10, randomState=0):
+        """Return IVFIndex of points (numpy array of points x dimensions). nLists defaults to the square root of the 
+        number of points. Centroids are fitted by nIter iterations of k-means from randomly chosen points.
+        """
+        points = numpy.asarray(points, dtype=numpy.float64)
+        nLists = max(1, int(round(numpy.sqrt(len(points))))) if nLists is None else min(nLists, len(points))
+        centroids = points[numpy.random.RandomState(randomState).choice(len(points), nLists, replace=False)]
+        for i in range(nIter):
+            assignment = squaredDistances(points, centroids).argmin(axis=1)
+            counts = numpy.bincount(assignment, minlength=nLists)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, assignment, points)
+            centroids[counts>0] = sums[counts>0]/counts[counts>0,None]  # empty lists keep their centroid
+        assignment = squaredDistances(points, centroids).argmin(axis=1)
+        ids = numpy.argsort(assignment, kind="stable")
+        offsets = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(assignment, minlength=nLists))])
+        return cls(centroids, offsets, ids, points[ids])
+
+    @classmethod
+    def load(cls, filepath):
+        """Return IVFIndex saved by save().
+        """
+        with numpy.load(filepath) as data:
+            return cls(data["centroids"], data["offsets"], data["ids"], data["points"])
+
+    def save(self, filepath):
+        """Save this index as a .npz file.
+        """
+        numpy.savez(filepath, centroids=self.centroids, offsets=self.offsets, ids=self.ids, points=self.points)
+
+    def query(self, X, k=1, nProbe=8, blockSize=10000):
+        """Return (distances, indices) of the (approximate) k nearest points to each row of X, nearest first, as numpy
+        arrays of rows x k. If the searched lists have fewer than k points, the remaining distances are inf and indices
+        -1. Queries are processed blockSize rows at a time, and each block searches one list at a time for all of its 
+        queries which probe that list.
+        """
+        X = numpy.asarray(X, dtype=numpy.float64)
+        nProbe = min(nProbe, self.nLists)
+        distances = numpy.full((len(X), k), numpy.inf)
+        indices = numpy.full((len(X), k), -1)
+        for start in range(0, len(X), blockSize):
+            block = X[start:start+blockSize]
+            bestDistances, bestIndices = distances[start:start+blockSize], indices[start:start+blockSize]
+            probes = numpy.argpartition(squaredDistances(block, self.centroids), nProbe-1, axis=1)[:,:nProbe] \
+                if nProbe<self.nLists else numpy.tile(numpy.arange(self.nLists), (len(block),1))
+
+            # Group (query, list) pairs by list
+            lists = probes.ravel()
+            order = numpy.argsort(lists, kind="stable")
+            queries, lists = numpy.repeat(numpy.arange(len(block)), nProbe)[order], lists[order]
+            bounds = numpy.searchsorted(lists, numpy.arange(self.nLists+1))
+            for i in range(self.nLists):
+                rows, members = queries[bounds[i]:bounds[i+1]], slice(self.offsets[i], self.offsets[i+1])
+                if len(rows)==0 or self.offsets[i]==self.offsets[i+1]: continue
+                candidates = numpy.concatenate([bestDistances[rows], squaredDistances(block[rows], self.points[members])], axis=1)
+                candidateIndices = numpy.concatenate([bestIndices[rows], numpy.broadcast_to(self.ids[members], 
+                                                      (len(rows), self.offsets[i+1]-self.offsets[i]))], axis=1)
+                top = numpy.argpartition(candidates, k-1, axis=1)[:,:k]
+                bestDistances[rows] = numpy.take_along_axis(candidates, top, axis=1)
+                bestIndices[rows] = numpy.take_along_axis(candidateIndices, top, axis=1)
+
+        order = numpy.argsort(distances, axis=1)
+        return numpy.sqrt(numpy.take_along_axis(distances, order, axis=1)), numpy.take_along_axis(indices, order, axis=1)
+
+def benchmarkNeighbourIndex(points, queries, k=10, nLists=None, nProbes=[1,2,4,8,16,32]):
+    """Compare recall and query time of IVFIndex for each of nProbes with the exact KDTree, and return a data frame 
+    with columns "recall" (mean fraction of the exact k nearest neighbours found), "seconds" and "speedup" (over exact).
+        > benchmarkNeighbourIndex(atl.coords["filtered"].values, coords.values)
+    """
+    import time
+    from sklearn.neighbors import KDTree
+    tree = KDTree(points)
+    start = time.time()
+    exact = tree.query(queries, k=k)[1]
+    exactTime = time.time() - start
+    index = IVFIndex.build(points, nLists=nLists)
+
+    result = [["exact", 1., exactTime]]
+    for nProbe in nProbes:
+        start = time.time()
+        indices = index.query(queries, k=k, nProbe=nProbe)[1]
+        seconds = time.time() - start
+        recall = numpy.mean([len(numpy.intersect1d(row, exactRow)) for row,exactRow in zip(indices, exact)])/k
+        result.append([nProbe, recall, seconds])
+    df = pandas.DataFrame(result, columns=["nProbe","recall","seconds"]).set_index("nProbe")
+    df["speedup"] = exactTime/df["seconds"]
+    return df
+
+permutationWorker = {}
+
+def initPermutationWorker(values, x, thresholds):
+    """Stores the arrays used by countPermutations in this process, so that they are only sent to each worker process once.
+    """
+    permutationWorker['values'] = values
+    permutationWorker['x'] = x
+    permutationWorker['thresholds'] = thresholds
+
+def countPermutations(seed, nPermutations):
+    """Correlate all rows of permutationWorker['values'] with nPermutations shuffles of permutationWorker['x'] (both 
+    centred and scaled to unit norm), and return the number of absolute correlations at or above each of 
+    permutationWorker['thresholds'] (sorted ascending).
+    """
+    values, x, thresholds = permutationWorker['values'], permutationWorker['x'], permutationWorker['thresholds']
+    rng = numpy.random.default_rng(seed)
+    shuffled = rng.permuted(numpy.tile(x, (nPermutations,1)), axis=1)  # nPermutations x samples
+    null = numpy.sort(numpy.abs(values.dot(shuffled.T)), axis=None)
+    return len(null) - numpy.searchsorted(null, thresholds, side='left')
+
+def permutationQValues(values, x, nPermutations, blockSize=100, n_jobs=1, randomState=0):
+    """Return empirical q-values of the correlation of each row of values (genes x samples) with x, given both centred 
+    and scaled to unit norm, so that correlations are values.dot(x).
+    All genes are correlated with nPermutations shuffles of x, blockSize shuffles at a time, so memory is bounded by 
+    the number of genes x blockSize. Only the number of null correlations at or above each observed one is kept. The
+    false discovery rate at threshold t is (null correlations >= t / nPermutations) / (observed correlations >= t), 
+    and the q-value of a gene is the lowest rate over thresholds at or below its absolute correlation. 
+    Blocks are run over n_jobs processes if n_jobs is not 1, and results do not depend on n_jobs.
+    Genes whose correlation is not finite (eg. NaN values) get NaN.
+    """
+    observed = numpy.abs(values.dot(x))
+    finite = numpy.isfinite(observed)
+    thresholds = numpy.sort(observed[finite])
+    blocks = [min(blockSize, nPermutations-start) for start in range(0, nPermutations, blockSize)]
+    seeds = numpy.random.SeedSequence(randomState).spawn(len(blocks))
+
+    if n_jobs==1:
+        initPermutationWorker(values[finite], x, thresholds)
+        counts = sum(countPermutations(seed, size) for seed,size in zip(seeds, blocks))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=initPermutationWorker, 
+                                 initargs=(values[finite], x, thresholds)) as executor:
+            counts = sum(executor.map(countPermutations, seeds, blocks))
+    permutationWorker.clear()
+
+    discoveries = len(thresholds) - numpy.searchsorted(thresholds, thresholds, side='left')
+    rates = numpy.minimum(counts/nPermutations/discoveries, 1)
+    qvalues = numpy.full(len(observed), numpy.nan)
+    qvalues[finite] = numpy.minimum.accumulate(rates)[numpy.searchsorted(thresholds, observed[finite], side='left')]
+    return qvalues
+
+def fingerprint(values, *items, blockSize=1000):
+    """Return a hash of numpy array values and of the string representation of each of items, which identifies a fitted 
+    model of values. values are hashed blockSize rows at a time, so a memory-mapped array is not read in all at once.
+    """
+    import hashlib
+    key = hashlib.sha1(("%s %s" % (values.shape, values.dtype)).encode())
+    for start in range(0, values.shape[0], blockSize):
+        key.update(numpy.ascontiguousarray(values[start:start+blockSize]).tobytes())
+    for item in items:
+        key.update(str(item).encode())
+    return key.hexdigest()
+
+def create_atlas(expressionDatafile, sampleDatafile, threshold=0.2, factors=['Platform_Category'], biologicalFactors=[]):
     """Create atlas expression matrix from input files. expressionDatafile is the full path to the csv file 
     (readable into a DataFrame by pandas.read_csv function) that contains all the datasets concatenated columnwise.
     sampleDatafile is the full path to the csv file that contain all sample information. This table must contain
     a column named 'Platform_Category', which is the variable to used to filter out genes with high variance.
+    Both files should have ids (genes and samples respectively) in the first column.
     Note that in the expression matrix, RNASeq data should have zeros as zeros, not nans.
+    Genes where the fraction of variance due to Platform_Category is above threshold are filtered out. This fraction is
+    calculated for all genes at once, as the between platform sum of squares over the total sum of squares of the rank
+    transformed values. Other columns of the sample table can be added to factors, in which case variance is partitioned
+    over all of them in order (see functions.variance_partition), and genes are filtered on the total fraction of the
+    factors not in biologicalFactors. Eg. factors=['Platform_Category','Dataset Name','Cell Type'] with 
+    biologicalFactors=['Cell Type'] keeps genes driven by cell type while removing those driven by platform or dataset.
     """
-    # Using rpy2 package to plug in R. Also need variancePartition R package installed in this environment.
-    import rpy2
-    import rpy2.robjects as robjects
-    from rpy2.robjects.packages import importr
-    import rpy2.robjects.numpy2ri, rpy2.robjects.pandas2ri
-    rpy2.robjects.numpy2ri.activate()
-    rpy2.robjects.pandas2ri.activate()
-    variancePartition = importr('variancePartition')
+    import functions
 
     # Read in expression data and sample metadata.
-    data        = pandas.read_csv(expressionDatafile)
-    metadata    = pandas.read_csv(sampleDatafile)
+    data        = pandas.read_csv(expressionDatafile, index_col=0)
+    metadata    = pandas.read_csv(sampleDatafile, index_col=0).reindex(data.columns)
     data.dropna(how='any', inplace=True) # Drop genes that are not measurable in every dataset due to probes being absent 
 
     # Search for platform dependent genes 
-    form              = robjects.Formula('~ Platform_Category')
-    varPart           = variancePartition.fitExtractVarPartModel(transform_to_percentile(data), form, metadata[['Platform_Category']])
+    varPart           = functions.calculate_variance_partition(rankTransform(data), metadata, factors=factors)
+    varPart           = varPart[[factor for factor in factors if factor not in biologicalFactors]].sum(axis=1).values
 
-    sel_varPart       = numpy.array(varPart)[0] <= 0.2 #This is the filtering step
+    sel_varPart       = varPart <= threshold #This is the filtering step
     genes_to_keep     = data.index.values[sel_varPart] #genes_to_keep is an array holding all the genes that pass the filter
 
-    filtered_data     = aransform(data.loc[genes_to_keep].copy())
+    filtered_data     = rankTransform(data.loc[genes_to_keep])
     return filtered_data
     
 
 class Atlas(object):
     """Define the atlas object, which is specified by the directory where the atlas files are, and atlas type.
-    Note that expression matrix will be read in at object initialisation stage.
+    Note that gene and sample tables are read in at object initialisation stage, but each expression matrix in 
+    self.annData is only built when it is first accessed.
     """
-    def __init__(self, pathToAtlasData, atlasType):
+    def __init__(self, pathToAtlasData, atlasType, useCache=True, storage="memory", dtype=None, filteredOnly=False, compact=False):
+        """If useCache is True, the expression matrix and gene/sample tables are read from the binary cache if there 
+        is a valid one, otherwise they are read from the text files and the cache is written for next time.
+        storage can be "memory" or "mmap". With "mmap", expression matrices are memory-mapped read-only from the cache
+        (written there on first use), so that several processes on one host share the same pages instead of each
+        holding a private copy. dtype of the matrices defaults to float32 for "mmap" and float64 for "memory".
+        Each matrix of self.annData is only built when it is first accessed. If filteredOnly is True, only the genes
+        where genes["inclusion"] is True are ever loaded, and self.annData["all"] is not available.
+        If compact is True, rank transformed matrices ("filtered" and "projection") are kept as RankMatrix objects in
+        self.ranks, and expression(), runPCA() and projection() work from these. self.annData of these keys are
+        then only decoded to floats if they are accessed directly.
+        """
+        if storage not in ["memory", "mmap"]:
+            raise Exception("storage must be one of 'memory' or 'mmap', not '%s'" % storage)
+        elif storage=="mmap" and not useCache:
+            raise Exception("storage='mmap' requires useCache=True, since arrays are memory-mapped from the cache")
+        if dtype is None:
+            dtype = numpy.float32 if storage=="mmap" else numpy.float64
 
         self.pathToAtlasData = pathToAtlasData
+        self.storage = storage
+        self.filteredOnly = filteredOnly
+        self.compact = compact
+        self.dtype = dtype
         paths = filepaths(self.pathToAtlasData, atlasType)
+        cache = cachePath(self.pathToAtlasData, atlasType)
 
-        genes = pandas.read_csv(paths.get('genes'), sep="\t", index_col=0)
-        samples = pandas.read_csv(paths.get('samples'), sep="\t", index_col=0)
-        df = pandas.read_csv(paths.get('expression'), sep="\t", index_col=0)
-        colours = json.load(open(paths.get('colours')))
+        if not (useCache and paths.get('cache')):
+            genes = pandas.read_csv(paths.get('genes'), sep="\t", index_col=0)
+            samples = pandas.read_csv(paths.get('samples'), sep="\t", index_col=0)
+            if filteredOnly and not useCache:  # skip parsing rows of genes which are not included
+                geneIds = pandas.read_csv(paths.get('expression'), sep="\t", index_col=0, usecols=[0]).index
+                included = set(genes[genes["inclusion"]].index)
+                df = pandas.read_csv(paths.get('expression'), sep="\t", index_col=0, 
+                                     skiprows=[i+1 for i,geneId in enumerate(geneIds) if geneId not in included])
+            else:
+                df = pandas.read_csv(paths.get('expression'), sep="\t", index_col=0)
+                geneIds = df.index
 
-        # Perform some validation.
-        if set(genes.index)!=set(df.index):
-            raise Exception("index of genes does not match index of expression")
-        elif set(samples.index)!=set(df.columns):
-            raise Exception("index of samples does not match columns of expression")
-        df = df[samples.index].loc[genes.index]
+            # Perform some validation.
+            if set(genes.index)!=set(geneIds):
+                raise Exception("index of genes does not match index of expression")
+            elif set(samples.index)!=set(df.columns):
+                raise Exception("index of samples does not match columns of expression")
+
+            if useCache:
+                try:
+                    writeCache(cache, paths, df, genes, samples)
+                    paths['cache'] = cache
+                except OSError as e:
+                    if storage=="mmap": raise
+                    print("Could not write atlas cache:", e)
+
+        # Matrices are read from the memory-mapped cache if available, otherwise gathered from df when needed.
+        # Note that we re-calculate the expression values as ranks for filtered matrix.
+        if useCache and paths.get('cache'):
+            values, genes, samples = readCache(paths['cache'], mmap_mode='r')
+            select = lambda positions, rows=slice(None): values[rows] if positions is None else values[rows][:,positions]
+        else:
+            select = lambda positions, rows=slice(None): orderedValues(df, genes, samples.iloc[rows], positions)
+        inclusion = numpy.flatnonzero(genes["inclusion"].values.astype(bool))
+        filteredValues = lambda rows=slice(None): \
+            rankTransform(pandas.DataFrame(select(inclusion, rows).transpose()), dtype=dtype).values.transpose()
+        if storage=="mmap":  # built and written to the cache a block of samples at a time
+            allValues = lambda: cachedArray(cache, "expression", dtype, (len(samples), len(genes)), lambda rows: select(None, rows))
+            buildFiltered = lambda: cachedArray(cache, "filtered", dtype, (len(samples), len(inclusion)), filteredValues)
+            buildRanks = lambda: RankMatrix(cachedArray(cache, "filtered", RankMatrix.codeType(len(inclusion)), (len(samples), len(inclusion)),
+                                                        lambda rows: RankMatrix.fromExpression(select(inclusion, rows)).codes))
+        else:
+            allValues = lambda: numpy.array(select(None), dtype=dtype)
+            buildFiltered = filteredValues
+            buildRanks = lambda: RankMatrix.fromExpression(select(inclusion))
+        self.ranks = LazyDict({"filtered": buildRanks} if compact else {})
+        if compact:
+            buildFiltered = lambda: self.ranks["filtered"].decode(dtype=dtype)
+        self.sampleTable = samples
+        self.geneTable = genes
+        colours = json.load(open(paths.get('colours')))
 
-        # Construct instance vars - note that we re-calculate the expression values as ranks for filtered matrix
         keys = ["all","filtered","projection"]
-        self.annData = {"all": anndata.AnnData(X=df.transpose(), obs=samples, var=genes)}
-        self.annData["filtered"] = self.annData["all"][:,genes[genes["inclusion"]].index]
-        self.annData["filtered"].X = rankTransform(self.annData["filtered"].to_df().transpose()).transpose()
+        self.annData = LazyDict({"all": self.buildAll(allValues), 
+                                 "filtered": lambda: anndata.AnnData(X=buildFiltered(), obs=samples, var=genes.iloc[inclusion])})
         self.annData["projection"] = None  # set after projection() is run
+        self.projectionSamples = None  # sample annotations of projection, see projection()
+        self.testExpression = None     # rank transformed test expression of projection, see projection()
 
         self.colours = dict([(key, deepcopy(colours['colours'])) for key in keys])   # {"all": {"Cell Type":{"B cell":"#cccccc", ...}, ...}, ... }
         self.ordering = dict([(key, deepcopy(colours['ordering'])) for key in keys]) # {"all": {"Cell Type":["CD8+ T cell","CD4+ T cell", ...], ...}, ...}
         self.pca = None
+        self.pcaFitTime = None
+        self.pcaModels = {}  # {fingerprint: (PCAModel, coordinates)}, see runPCA
+        self.pcaSettings = {}  # {key: keyword arguments of the last runPCA call for key}, see atlasPCA
+        self.pcaKey = None     # key of the matrix self.pca was fitted to
+        self.cache = paths.get('cache') if useCache else None
+        self.neighbourIndex = None  # (fingerprint of self.coords["filtered"], index), see transferLabels
         self.coords = {"all":None, "filtered":None, "projection":None} # pca coords performed on expression matrix of matching key
 
+    def buildAll(self, allValues):
+        """Return the function that builds self.annData["all"] from allValues().
+        """
+        def build():
+            if self.filteredOnly:
+                raise Exception("annData['all'] is not available, since this atlas was created with filteredOnly=True")
+            return anndata.AnnData(X=allValues(), obs=self.sampleTable, var=self.geneTable)
+        return build
+
     def expression(self, key="filtered"):
         """Return DataFrame of expression (genes x samples).
-        If key="filtered", only return expression for genes included in the atlas
+        If key="filtered", only return expression for genes included in the atlas.
+        With storage="mmap", the DataFrame is a read-only view of the memory-mapped array rather than a copy. Otherwise
+        it is a copy, so changing it does not change self.annData[key].
+        If compact is True, it is decoded from self.ranks[key] unless self.annData[key] has already been built.
+        For key="projection", the atlas and test matrices are only concatenated here (a copy) if self.annData[key] has 
+        not been built yet.
         """
-        return self.annData[key].to_df().transpose()
+        if key in self.ranks.builders or key in self.ranks:
+            if key not in self.annData:
+                return pandas.DataFrame(self.ranks[key].decode(dtype=self.dtype).transpose(), index=self.genes(key).index, 
+                                        columns=self.samples(key).index, copy=False)
+        if key=="projection" and key not in self.annData:
+            return pandas.DataFrame(numpy.concatenate([numpy.asarray(self.annData["filtered"].X).transpose(), self.testExpression.values], axis=1), 
+                                    index=self.genes(key).index, columns=self.samples(key).index, copy=False)
+        return pandas.DataFrame(numpy.asarray(self.annData[key].X).transpose(), index=self.annData[key].var_names, 
+                                columns=self.annData[key].obs_names, copy=self.storage!="mmap")
 
     def samples(self, key="filtered"):
+        """Return DataFrame of sample annotations. This does not build self.annData[key] if it has not been built yet.
+        """
+        if key in ["all","filtered"] and key not in self.annData:
+            return self.sampleTable
+        if key=="projection" and key not in self.annData:
+            return self.projectionSamples
         return self.annData[key].obs
 
     def genes(self, key="filtered"):
+        """Return DataFrame of gene annotations. This does not build self.annData[key] if it has not been built yet.
+        """
+        if key in ["all","filtered"] and key not in self.annData:
+            return self.geneTable if key=="all" else self.geneTable[self.geneTable["inclusion"]]
+        if key=="projection" and key not in self.annData:
+            return self.genes()
         return self.annData[key].var
 
     def convertGeneSymbolsToEnsemblIds(self, df):
@@ -140,14 +751,75 @@ class Atlas(object):
         print("Shape before converting to Ensembl ids:", shape, ", shape after:", df.shape)
         return df
 
-    def runPCA(self, key="filtered"):
-        """Perform PCA and save coordinates in 3d.
+    def runPCA(self, key="filtered", solver=None, nComponents=10, nCoords=3, randomState=0, persist=True, maxMemory=512*1024**2):
+        """Perform PCA and save coordinates of the first nCoords components in self.coords[key] (columns x, y, z, then
+        PC4, PC5, ... if nCoords>3). The fitted model is in self.pca as a PCAModel, and the time taken to fit (or load)
+        it, in seconds, is in self.pcaFitTime. solver can be one of:
+            "full": exact dense SVD of the samples x genes matrix (sklearn), the default unless compact is True.
+            "randomized": randomized truncated SVD (sklearn), much faster when nComponents is small.
+            "arpack": truncated SVD through ARPACK (sklearn), nComponents must be less than the number of samples.
+            "gram": eigen decomposition of the samples x samples Gram matrix (PCAModel.fitGram), which is fast when
+                there are many fewer samples than genes. This is the default if compact is True, since it only decodes 
+                blocks of genes of self.ranks[key] at a time.
+            "incremental": out-of-core IncrementalPCA (sklearn) over blocks of samples (PCAModel.fitIncremental), so 
+                memory stays around maxMemory bytes. Use with storage="mmap" or compact=True for atlases larger than RAM.
+        Fitted models are kept in self.pcaModels, keyed by a fingerprint of the matrix and these settings, so running
+        this again on an unchanged matrix does not refit. If persist is True and this atlas has a cache directory, 
+        models are also saved there and reused by later Atlas objects. Projections use the model of the last call with
+        key="filtered" (see atlasPCA).
+        """
+        import time
+        if nComponents is not None and nCoords>nComponents:
+            raise Exception("nCoords (%s) can not be more than nComponents (%s)" % (nCoords, nComponents))
+        self.pcaSettings[key] = dict(solver=solver, nComponents=nComponents, nCoords=nCoords, randomState=randomState, 
+                                     persist=persist, maxMemory=maxMemory)
+        compact = key in self.ranks.builders or key in self.ranks
+        if solver is None:
+            solver = "gram" if compact else "full"
+        if solver not in ["full", "randomized", "arpack", "gram", "incremental"]:
+            raise Exception("solver must be one of 'full', 'randomized', 'arpack', 'gram' or 'incremental', not '%s'" % solver)
+        X = self.ranks[key] if compact else self.annData[key].X
+
+        start = time.time()
+        modelKey = fingerprint(X.codes if compact else numpy.asarray(X), list(self.samples(key).index), 
+                               list(self.genes(key).index), solver, nComponents, randomState, 
+                               maxMemory if solver=="incremental" else None)
+        modelFile = os.path.join(self.cache, "pca_%s.npz" % modelKey) if self.cache else None
+        if modelKey not in self.pcaModels and modelFile and os.path.exists(modelFile):
+            self.pcaModels[modelKey] = PCAModel.load(modelFile)
+        if modelKey not in self.pcaModels:
+            if solver=="gram":
+                model, df = PCAModel.fitGram(X, n_components=nComponents)
+            elif solver=="incremental":
+                model, df = PCAModel.fitIncremental(X, n_components=nComponents, maxMemory=maxMemory)
+            else:
+                pca = PCA(n_components=nComponents, svd_solver=solver, random_state=randomState)
+                df = pca.fit_transform(X.decode(dtype=self.dtype) if compact else X)
+                model = PCAModel.fromSklearn(pca)
+            self.pcaModels[modelKey] = (model, df)
+            if persist and modelFile:
+                try:
+                    model.save(modelFile, df)
+                except OSError as e:
+                    print("Could not save PCA model to cache:", e)
+        self.pca, df = self.pcaModels[modelKey]
+        self.pcaKey = key
+        self.pcaFitTime = time.time() - start
+
+        df = df[:,:nCoords]
+        columns = ['x','y','z'][:df.shape[1]] + ['PC%s' % (i+1) for i in range(3, df.shape[1])]
+        self.coords[key] = pandas.DataFrame(df, index=self.samples(key).index, columns=columns)
+
+    def atlasPCA(self):
+        """Return the PCA model of the filtered atlas which projections use. This is self.pca if it was last fitted to 
+        the filtered atlas, otherwise runPCA() is run with the settings of the last runPCA(key="filtered") call, or 
+        defaults if there was none.
         """
-        self.pca = PCA(n_components=10, svd_solver='full')
-        df = self.pca.fit_transform(self.annData[key].X)
-        self.coords[key] = pandas.DataFrame(df[:,:3], index=self.annData[key].obs_names, columns=['x','y','z'])
+        if self.pca is None or self.pcaKey!="filtered":
+            self.runPCA(key="filtered", **self.pcaSettings.get("filtered", {}))
+        return self.pca
 
-    def projection(self, testData, testKey="original", testPointColours="green", randomPointColours="black"):
+    def projection(self, testData, testKey="original", testPointColours="green", randomPointColours="black", chunkSize=10000):
         """Perform projection of testData onto this atlas.
         Afterwards, various object attributes are assigned:
             self.annData["projection"]: AnnData of expression where X = concatenated (columnwise) data frame of 
@@ -157,10 +829,16 @@ class Atlas(object):
             self.coords["projection"]: projected coordinates as a data frame.
             self.ordering["projection"]: extends self.ordering to include test values
             self.colours["colours]: extends self.colours to include colours for test points
+        The concatenated matrix is a copy of the whole atlas, so self.annData["projection"] is only built when it is 
+        first accessed. Until then, only the rank transformed test expression is kept (self.testExpression, or 
+        self.ranks["projection"] if compact is True), and samples("projection"), genes("projection") and 
+        expression("projection") work from that and the atlas without building it.
+        Test expression is aligned to atlas genes and rank transformed chunkSize samples at a time, so a sparse test 
+        expression matrix is only densified one chunk at a time.
         """
         # Some validation before projecting
-        df = self.expression()
-        commonGenes = testData.expression(key=testKey).index.intersection(df.index)  # common index between test and atlas
+        atlasGenes = self.genes().index
+        commonGenes = testData.genes(key=testKey).index.intersection(atlasGenes)  # common index between test and atlas
         if not testData.sampleMap:
             raise Exception("No sampleMap, which is a required dictionary that maps samples columns of atlas to that of test data.")
         if len(commonGenes)==0:
@@ -174,17 +852,31 @@ class Atlas(object):
             if len(set(sm.keys()).intersection(set(self.samples().columns)))==0 or len(set(sm.values()).intersection(set(testData.samples().columns)))==0:
                 raise Exception("SampleMap specified for test data seems incorrect.")
     
-        # We reindex on df.index, not on commonGenes, since pca is done on df. This means any genes in df not found in 
-        # test will gene None assigned - we will live with this, as long as there aren't so many.
+        # We reindex on atlasGenes, not on commonGenes, since pca is done on atlas genes. This means any genes in atlas not
+        # found in test will gene None assigned - we will live with this, as long as there aren't so many.
         print("Projecting test onto the atlas using %s common genes" % len(commonGenes))
-        dfTest = rankTransform(testData.expression(key=testKey).reindex(df.index))
-        expression = pandas.concat([df, dfTest], axis=1)    # combined expression matrix (rank transformed)
+        testSamples = testData.samples(key=testKey).index
+        chunks = [slice(start, start+chunkSize) for start in range(0, len(testSamples), chunkSize)]
 
-        # Perform pca on atlas
-        self.runPCA()
+        # Perform pca on atlas, unless it has been done already
+        self.atlasPCA()
         
         # Make projection
-        testCoords = pandas.DataFrame(self.pca.transform(dfTest.values.T)[:,:3], index=dfTest.columns, columns=['x','y','z'])
+        n = len(atlasGenes)
+        if self.compact:
+            testRanks = RankMatrix(numpy.concatenate([RankMatrix.fromExpression(testData.values(atlasGenes, key=testKey, rows=rows)).codes 
+                                                      for rows in chunks]), n)
+            testCoords = self.pca.transform(testRanks)
+        else:
+            values = numpy.empty((len(testSamples), n))  # samples x genes
+            for rows in chunks:
+                rankArray(testData.values(atlasGenes, key=testKey, rows=rows).transpose(), out=values[rows].transpose())
+            values -= n + 1  # rank transform as rankTransform does
+            values /= -n
+            dfTest = pandas.DataFrame(values.transpose(), index=atlasGenes, columns=testSamples, copy=False)
+            testCoords = self.pca.transform(values)
+        columns = self.coords["filtered"].columns  # same coordinates as the last runPCA(key="filtered")
+        testCoords = pandas.DataFrame(testCoords[:,:len(columns)], index=testSamples, columns=columns)
         self.coords["projection"] = self.coords["filtered"].append(testCoords)
         
         # Merge sample columns of test and atlas - we can only do this for columns found in testData.sampleMap
@@ -204,17 +896,181 @@ class Atlas(object):
         # We will also add a column to projectionSamples to keep track of which are atlas samples and which are projected ones.
         projectionSamples["projection"] = [None for index in self.samples().index] + [testData.name for index in testData.samples(key=testKey).index]
 
-        # Add this to annData object
-        self.annData["projection"] = anndata.AnnData(X=expression.transpose(), obs=projectionSamples, var=self.annData["filtered"].var)
+        # Add this to annData object, to be built when first accessed
+        self.projectionSamples = projectionSamples
+        if self.compact:
+            self.ranks["projection"] = self.ranks["filtered"].concatenate(testRanks)
+            self.testExpression = None
+            buildExpression = lambda: self.ranks["projection"].decode(dtype=self.dtype)
+        else:
+            self.testExpression = dfTest
+            buildExpression = lambda: self.expression("projection").values.transpose()
+        var = self.genes()
+        self.annData.pop("projection", None)
+        self.annData.builders["projection"] = lambda: anndata.AnnData(X=buildExpression(), obs=projectionSamples, var=var)
         
         return self
 
-    def calculateTestDataTrajectory(self, testData):
+    def projectMany(self, testDataList, testKey="original", nCoords=3, chunkSize=10000):
+        """Project several TestData objects onto this atlas in one pass, and return a dictionary of projected coordinates 
+        keyed on testData.name, eg. {"haem": DataFrame of x,y,z for each sample of haem, ...}.
+        All test expression matrices are aligned to the atlas genes into one preallocated matrix, rank transformed 
+        together, and projected with a single matrix multiplication against the (cached) PCA of the atlas.
+        Unlike projection(), this does not change self.annData, self.coords, self.colours or self.ordering, so the
+        atlas side is never rebuilt. Sparse test expression matrices are densified chunkSize samples at a time.
+        """
+        atlasGenes = self.genes().index
+        names = [testData.name for testData in testDataList]
+        if len(set(names))!=len(names):
+            raise Exception("Names of test data to project must be unique")
+
+        for name,testData in zip(names, testDataList):
+            commonGenes = testData.genes(key=testKey).index.intersection(atlasGenes)
+            if len(commonGenes)==0:
+                raise Exception("No genes common between test data %s and atlas, likely due to row ids not in Ensembl ids." % name)
+            elif len(commonGenes)/len(atlasGenes)<0.5:
+                raise Exception("Less than 50%% of genes in test data %s are common with atlas (%s common)" % (name, len(commonGenes)))
+
+        # Genes of atlas not found in test get NaN, which are ranked last, as in projection()
+        n = len(atlasGenes)
+        samples = [testData.samples(key=testKey).index for testData in testDataList]
+        values = numpy.empty((n, sum(len(index) for index in samples)))
+        ends = numpy.cumsum([len(index) for index in samples])
+        for testData,index,end in zip(testDataList, samples, ends):
+            for start in range(0, len(index), chunkSize):
+                block = testData.values(atlasGenes, key=testKey, rows=slice(start, start+chunkSize))
+                values[:,end-len(index)+start:end-len(index)+start+len(block)] = block.transpose()
+        rankArray(values, out=values)  # rank transform in place, as rankTransform does
+        values -= n + 1
+        values /= -n
+
+        coords = self.atlasPCA().transform(values.transpose())[:,:nCoords]
+        columns = ['x','y','z'][:coords.shape[1]] + ['PC%s' % (i+1) for i in range(3, coords.shape[1])]
+        return dict([(name, pandas.DataFrame(coords[end-len(index):end], index=index, columns=columns)) 
+                     for name,index,end in zip(names, samples, ends)])
+
+    def projectFile(self, filepath, outputFile, sep="\t", index_col=0, chunkSize=5000, rowChunkSize=100, nCoords=3, tempDir=None):
+        """Project test data too large to read into memory (such as single cell data with 100k+ cells) from a delimited 
+        text file of genes x cells, and write projected coordinates to outputFile (tab separated, cells x coordinates).
+        Memory stays flat regardless of the number of cells:
+            1. The file is read once, rowChunkSize rows at a time, keeping only atlas genes, which are stored as float32 
+               in a temporary memory-mapped array under tempDir (system default if None). Reading column subsets of a 
+               text file instead would parse the whole file again for every chunk of cells.
+            2. chunkSize cells at a time are then rank transformed over atlas genes (as in projection()), projected 
+               against the cached PCA of the atlas, and appended to outputFile.
+        Like projectMany(), this does not change self.annData, self.coords, self.colours or self.ordering.
+        Returns the number of cells projected.
+        """
+        import tempfile
+        atlasGenes = self.genes().index
+        cells = pandas.read_csv(filepath, sep=sep, index_col=index_col, nrows=0).columns
+        nCoords = min(nCoords, self.atlasPCA().n_components_)
+        columns = ['x','y','z'][:nCoords] + ['PC%s' % (i+1) for i in range(3, nCoords)]
+
+        with tempfile.TemporaryDirectory(dir=tempDir) as directory:
+            values = numpy.lib.format.open_memmap(os.path.join(directory, "test.npy"), mode="w+", dtype=numpy.float32, 
+                                                  shape=(len(atlasGenes), len(cells)))
+            values[:] = numpy.nan  # atlas genes not found in test are NaN, as in projection()
+            found = numpy.zeros(len(atlasGenes), dtype=bool)
+            for df in pandas.read_csv(filepath, sep=sep, index_col=index_col, chunksize=rowChunkSize):
+                positions = atlasGenes.get_indexer(df.index)
+                rows = numpy.flatnonzero(positions>=0)
+                rows = rows[~found[positions[rows]]]  # keep the first row of a duplicated gene
+                rows = rows[~pandas.Index(positions[rows]).duplicated()]
+                values[positions[rows]] = df.values[rows]
+                found[positions[rows]] = True
+
+            if found.sum()==0:
+                raise Exception("No genes common between test data and atlas, likely due to row ids not in Ensembl ids.")
+            elif found.sum()/len(atlasGenes)<0.5:
+                raise Exception("Less than 50% of genes in test data are common with atlas ({} common)".format(found.sum()))
+            print("Projecting test onto the atlas using %s common genes" % found.sum())
+
+            n = len(atlasGenes)
+            for start in range(0, len(cells), chunkSize):
+                block = rankArray(values[:,start:start+chunkSize])
+                block -= n + 1
+                block /= -n
+                coords = pandas.DataFrame(self.pca.transform(block.transpose())[:,:nCoords], 
+                                          index=cells[start:start+chunkSize], columns=columns)
+                coords.to_csv(outputFile, sep="\t", mode="w" if start==0 else "a", header=start==0)
+            del values
+        return len(cells)
+
+    def transferLabels(self, coords=None, k=10, columns=["Cell Type","Cell Lineage"], approximate=False, nLists=None, nProbe=8):
+        """Predict labels of projected samples from their k nearest atlas samples in PCA space, and return a tuple of 
+        (predictions, neighbours).
+        coords is a data frame of projected coordinates (samples x coordinates, eg. from projectMany() or projectFile()),
+        using the test samples of self.coords["projection"] if None. Only the columns of self.coords["filtered"] are used.
+        predictions is a data frame indexed on samples of coords, with the most common label among the neighbours for
+        each of columns, and its fraction of the k votes as "<column> fraction", eg. "Cell Type", "Cell Type fraction".
+        neighbours is a dictionary of data frames (samples x k, nearest first) with "sample" (atlas sample ids),
+        "distance", and the labels of the neighbours for each of columns.
+        All samples are queried at once against a KD-tree over self.coords["filtered"], which is only rebuilt when 
+        these coordinates change. For a large number of samples (eg. single cells), set approximate=True to use an 
+        IVFIndex with nLists lists instead, searching nProbe lists per sample (higher for better recall, lower for 
+        speed). This index is also saved in the cache directory of this atlas and reused by later Atlas objects.
+            > predictions, neighbours = atl.projection(test).transferLabels()
+        """
+        from sklearn.neighbors import KDTree
+        if self.coords["filtered"] is None:
+            self.atlasPCA()
+        atlasCoords = self.coords["filtered"]
+        if coords is None:
+            if self.coords["projection"] is None:
+                raise Exception("No projected coordinates, run projection() first or specify coords.")
+            samples = self.samples("projection")
+            coords = self.coords["projection"].loc[samples.index[pandas.notnull(samples["projection"])]]
+
+        # Build the index only if atlas coordinates (or type of index) have changed since it was last built
+        key = fingerprint(atlasCoords.values, list(atlasCoords.index), "ivf" if approximate else "kdtree", 
+                          nLists if approximate else None)
+        if self.neighbourIndex is None or self.neighbourIndex[0]!=key:
+            if approximate:
+                indexFile = os.path.join(self.cache, "ivf_%s.npz" % key) if self.cache else None
+                if indexFile and os.path.exists(indexFile):
+                    index = IVFIndex.load(indexFile)
+                else:
+                    index = IVFIndex.build(atlasCoords.values, nLists=nLists)
+                    if indexFile:
+                        try:
+                            index.save(indexFile)
+                        except OSError as e:
+                            print("Could not save neighbour index to cache:", e)
+            else:
+                index = KDTree(atlasCoords.values)
+            self.neighbourIndex = (key, index)
+        if approximate:
+            distances, indices = self.neighbourIndex[1].query(coords[atlasCoords.columns].values, k=k, nProbe=nProbe)
+        else:
+            distances, indices = self.neighbourIndex[1].query(coords[atlasCoords.columns].values, k=k)
+
+        predictions = pandas.DataFrame(index=coords.index)
+        neighbours = {"sample": pandas.DataFrame(numpy.where(indices>=0, atlasCoords.index.values[indices], None), index=coords.index),
+                      "distance": pandas.DataFrame(distances, index=coords.index)}
+        rows = numpy.repeat(numpy.arange(len(coords)), k)
+        for column in columns:
+            codes, labels = pandas.factorize(self.samples().loc[atlasCoords.index, column])
+            votes = numpy.where(indices>=0, codes[indices], -1)  # samples x k, -1 for missing labels, which get no vote
+            counts = numpy.zeros((len(coords), len(labels)+1), dtype=int)
+            numpy.add.at(counts, (rows, votes.ravel()), 1)
+            counts = counts[:,:-1]  # drop votes of missing labels, which were added to the last column
+            predictions[column] = labels.values[counts.argmax(axis=1)]
+            predictions["%s fraction" % column] = counts.max(axis=1)/k
+            neighbours[column] = pandas.DataFrame(numpy.where(votes>=0, labels.values[votes], None), index=coords.index)
+        return predictions, neighbours
+
+    def calculateTestDataTrajectory(self, testData, nPermutations=0, fdr=0.05, blockSize=100, n_jobs=1, randomState=0):
         """Once test data has been projected, those samples may lie along a trajectory and we can try to find genes whose expression are
         correlated with that trajectory.
+        Genes are kept if the p-value of their correlation is below 0.05. If nPermutations is more than 0, an empirical
+        false discovery rate is estimated instead, by correlating all genes with nPermutations shuffles of the trajectory
+        coordinates: the q-value of a gene is added as a "qvalue" column, and genes are kept if it is below fdr.
+        Permutations are correlated blockSize at a time (using about 8 x number of genes x blockSize bytes per block),
+        over n_jobs processes.
         """
         # projected coordinates (excluding random)
-        samples = self.annData["projection"].obs
+        samples = self.samples("projection")
         samples = samples[pandas.notnull(samples["projection"])]  # test data samples only
         df = self.coords["projection"].loc[samples.index] 
         
@@ -222,20 +1078,31 @@ class Atlas(object):
         pca = PCA(n_components=1, svd_solver='full')
         coords = pandas.Series(pca.fit_transform(df.values)[:,0], index=df.index)
         
-        # For each gene in test, calculate correlation between these coordinates and expression values
-        from scipy.stats import pearsonr
+        # For each gene in test, calculate correlation between these coordinates and expression values. This is done
+        # for all genes at once: with rows of expression and the coordinates centred, r is a matrix-vector product
+        # scaled by their norms, and the two sided p-value is that of pearsonr, from the t distribution with n-2 dof.
+        from scipy.special import stdtr
         df = testData.expression()
+        df = df[df.var(axis=1)!=0]
+        values = df.values - df.values.mean(axis=1)[:,None]
+        x = coords.values - coords.values.mean()
+        n = len(x)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            values /= numpy.sqrt((values**2).sum(axis=1))[:,None]
+            x /= numpy.sqrt((x**2).sum())
+            r = numpy.clip(values.dot(x), -1, 1)
+            p = 2*stdtr(n-2, -numpy.abs(r)*numpy.sqrt((n-2)/(1-r**2)))
         
-        geneCorr = []
-        for index,row in df.iterrows():
-            if row.var()==0: continue
-            corr = pearsonr(row, coords)
-            if corr[1]<0.05:
-                geneCorr.append([index,corr[0],abs(corr[0])])
-                
-        df = pandas.DataFrame(geneCorr, columns=['geneId','corr','abs_corr']).set_index('geneId')
+        df = pandas.DataFrame({'corr':r, 'abs_corr':numpy.abs(r)}, index=df.index.rename('geneId'))
+        if nPermutations>0:
+            df["qvalue"] = permutationQValues(values, x, nPermutations, blockSize=blockSize, n_jobs=n_jobs, randomState=randomState)
+            df = df[df["qvalue"]<fdr]
+        else:
+            df = df[p<0.05]
         df = df.sort_values('abs_corr', ascending=False)
-        df["symbol"] = [self.genes().at[geneId,'symbol'] if geneId in self.genes().index else geneId for geneId in df.index]
+        symbols = self.genes()['symbol']
+        df = df.join(symbols[~symbols.index.duplicated()])
+        df["symbol"] = df["symbol"].fillna(pandas.Series(df.index, index=df.index))
         return df
 
     '''           
@@ -250,9 +1117,36 @@ class Atlas(object):
         kmeans = self.expression().groupby(self.samples[group],axis=1).mean()
     '''
 
+def read10x(path):
+    """Return AnnData (cells x genes, with X as a sparse CSR matrix) of 10x Matrix Market output, where path is the 
+    directory with matrix.mtx, features.tsv (genes.tsv for older versions) and barcodes.tsv (each optionally gzipped), 
+    or the path to the matrix.mtx file itself. Genes are indexed on their ids (first column of features.tsv), and
+    their symbols (second column) are in the "symbol" column of var.
+    """
+    from scipy import io, sparse
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    def find(names):
+        for name in names:
+            for filename in [name, name + ".gz"]:
+                if os.path.exists(os.path.join(directory, filename)):
+                    return os.path.join(directory, filename)
+        raise Exception("None of %s found in %s" % (names, directory))
+
+    X = io.mmread(path if not os.path.isdir(path) else find(["matrix.mtx"]))  # genes x cells
+    features = pandas.read_csv(find(["features.tsv","genes.tsv"]), sep="\t", header=None, dtype=str)
+    barcodes = pandas.read_csv(find(["barcodes.tsv"]), sep="\t", header=None, dtype=str)
+    var = pandas.DataFrame(index=features[0].values)
+    if features.shape[1]>1:
+        var["symbol"] = features[1].values
+    return anndata.AnnData(X=sparse.csr_matrix(X.transpose(), dtype=numpy.float64), obs=pandas.DataFrame(index=barcodes[0].values), var=var)
+
 class TestData(object):
     """Read data which will be projected onto the atlas. We call this test data. Since test data may come in a variety
     of formats, we want to be more flexible with our initialisation.
+    filepath may be a delimited text file of genes x samples, an .h5ad file, or 10x Matrix Market output (see read10x).
+    Single cell data from .h5ad and 10x files keep a sparse expression matrix through aggregateSamples, addRandom and 
+    Atlas.projection, which only densify a chunk of samples at a time (see values()). For these, samples defaults to
+    obs of the file.
     """
     
     def __init__(self, name, **kwargs):
@@ -261,12 +1155,27 @@ class TestData(object):
         self.randomPrefix = kwargs.get('randomPrefix', 'random')
         self.sampleMap = kwargs.get('sampleMap', {})  # maps atlas columns to testData columns. {'Cell Type':'test_data_column',...}
 
+        annData = None
         if 'expression' in kwargs:  # expression matrix as a pandas.DataFrame object
             df = kwargs['expression']
+        elif kwargs['filepath'].endswith('.h5ad'):
+            annData = anndata.read_h5ad(kwargs['filepath'])
+        elif os.path.isdir(kwargs['filepath']) or '.mtx' in os.path.basename(kwargs['filepath']):
+            annData = read10x(kwargs['filepath'])
         else:
             df = pandas.read_csv(os.path.join(kwargs['filepath']), sep=kwargs.get('sep','\t'), index_col=kwargs.get('index_col',0))
         samples = kwargs.get('samples')
 
+        if annData is not None:
+            from scipy import sparse
+            if samples is None:
+                samples = annData.obs
+            if set(samples.index)!=set(annData.obs_names):
+                raise Exception("index of samples does not match samples of expression")
+            X = annData.X[annData.obs_names.get_indexer(samples.index)]
+            self.annData = {'original':anndata.AnnData(X=sparse.csr_matrix(X) if sparse.issparse(X) else X, obs=samples, var=annData.var)}
+            return
+
         # Validate
         if set(samples.index)!=set(df.columns):
             raise Exception("index of samples does not match columns of expression")
@@ -276,51 +1185,84 @@ class TestData(object):
         self.annData = {'original':anndata.AnnData(X=df.transpose(), obs=samples)}
 
     def expression(self, key="original"):
+        """Return DataFrame of expression (genes x samples). This is a dense copy, even if the expression matrix is 
+        sparse - use values() to work with a subset of samples.
+        """
         return self.annData[key].to_df().transpose()
 
     def samples(self, key="original"):
         return self.annData[key].obs
 
-    def addRandom(self, n=3, key="original", prefix="random"): 
+    def genes(self, key="original"):
+        return self.annData[key].var
+
+    def values(self, genes, key="original", rows=slice(None)):
+        """Return dense numpy array of expression (samples x genes) for samples in rows, with columns in the order of
+        genes (a list of gene ids), and NaN for genes not found in this dataset. If the expression matrix is sparse,
+        only these samples are densified.
+        """
+        from scipy import sparse
+        X = self.annData[key].X[rows]
+        positions = self.annData[key].var_names.get_indexer(genes)
+        found = positions>=0
+        values = numpy.full((X.shape[0], len(genes)), numpy.nan)
+        values[:,found] = X[:,positions[found]].toarray() if sparse.issparse(X) else X[:,positions[found]]
+        return values
+
+    def addRandom(self, n=3, key="original", prefix="random", seed=None): 
         """Add some random values, based on distribution of values already present in this dataset.
         Parameters
             n (int): total number of random values added.
             key (str): one of ['original','aggregated',...] - which expression matrix should be used for value distribution and where random values 
                 should be added.
             prefix (str): used to add a prefix for sample ids of random values so that they can be identified.
+            seed (int): seed for choosing and shuffling samples, for reproducible results.
+        n samples are randomly chosen, and the values of each are shuffled across genes. The expression matrix is 
+        preallocated with room for the random samples, which are shuffled in place there with one permutation call, 
+        so the original values are copied once, rather than building and concatenating another AnnData object.
         """
-        import random
+        from scipy import sparse
         self.randomPrefix = prefix
+        rng = numpy.random.default_rng(seed)
+        X = self.annData[key].X  # samples x genes
 
-        # Target expression matrix we will work with (genes x samples)
-        df = self.annData[key].to_df().transpose()
-
-        # n columns are randomly chosen, then for each column we shuffle the values
-        n = min([n, len(df.columns)])
+        # n samples are randomly chosen, then for each sample we shuffle the values
+        n = min([n, X.shape[0]])
+        chosen = numpy.sort(rng.choice(X.shape[0], n, replace=False))
+        if sparse.issparse(X):  # only the chosen samples are densified, to be shuffled
+            values = rng.permuted(X[chosen].toarray(), axis=1)
+            values = sparse.vstack([X, sparse.csr_matrix(values)], format="csr")
+        else:
+            values = numpy.empty((X.shape[0]+n, X.shape[1]), dtype=X.dtype)
+            values[:X.shape[0]] = X
+            values[X.shape[0]:] = X[chosen]
+            rng.permuted(values[X.shape[0]:], axis=1, out=values[X.shape[0]:])
 
-        # Create a new AnnData object of random values and concatenate with existing annData
-        randomDf = pandas.DataFrame(index=df.index)
-        randomSamples = pandas.DataFrame(columns=self.annData[key].obs.columns)
-        for i,col in enumerate(random.sample(df.columns.to_list(), n)):
-            randomDf["%s%i" % (self.randomPrefix,i)] = df[col].reset_index(drop=True).sample(frac=1).to_list()
-            randomSamples.loc["%s%i" % (self.randomPrefix,i)] = [self.randomPrefix for item in randomSamples.columns]
-        self.annData[key] = self.annData[key].concatenate([anndata.AnnData(X=randomDf.transpose(), obs=randomSamples)], index_unique=None)
+        obs = self.annData[key].obs
+        randomSamples = pandas.DataFrame([[self.randomPrefix]*len(obs.columns)]*n, columns=obs.columns,
+                                         index=["%s%i" % (self.randomPrefix,i) for i in range(n)])
+        self.annData[key] = anndata.AnnData(X=values, obs=pandas.concat([obs, randomSamples]), var=self.annData[key].var)
 
-    def aggregateSamples(self, from_key="original", to_key="aggregated", sampleGroup=None, n=3):
+    def aggregateSamples(self, from_key="original", to_key="aggregated", sampleGroup=None, n=3, seed=None):
         """For single cell dataset, we can aggregate values based on membership in sampleGroup 
         (which must correspond to a column of self.annData[from_key].obs). Creates a self.annData[to_key] object 
         where obs has sampleGroup as a column.
             > testData.aggregateSamples(sampleGroup="celltype")
             > print(testData.expression("celltype").shape)
         n (int): how many points to represent the smallest cluster with
+        seed (int): seed for the random assignment of samples to aggregated samples, for reproducible results.
+        Each group is randomly split into aggregated samples of sampleSize members, leaving out the remaining members 
+        (at most sampleSize). This assignment is built once as a sparse indicator matrix (samples x aggregated samples),
+        so all aggregated samples are a single sparse matrix product with the expression matrix.
         """
-        import random
+        from scipy import sparse
+        samples = self.samples(key=from_key)
         if sampleGroup is None:
-            sampleGroup = self.samples(key=from_key).columns[0]
-        elif sampleGroup not in self.samples(key=from_key).columns:
+            sampleGroup = samples.columns[0]
+        elif sampleGroup not in samples.columns:
             raise Exception("'%s' is not found in annData['%s'].obs.columns" % (sampleGroup, from_key))
 
-        valueCounts = self.samples(key=from_key)[sampleGroup].value_counts().sort_values()
+        valueCounts = samples[sampleGroup].value_counts().sort_values()
         smallest = valueCounts.tolist()[0] # size of the smallest cluster
         
         if smallest<=3*n: # if the smallest cluster isn't at least 3 times the value of n, just use all of that cluster
@@ -330,23 +1272,26 @@ class TestData(object):
             raise Exception("Could not determine how many samples to aggregate together. Likely due to a cluster having only one member.")
         print("sample size for each cluster:", sampleSize)
 
-        aggregated = pandas.DataFrame(index=self.expression(key=from_key).index)
-        samples = pandas.DataFrame(columns=[sampleGroup])
-        for item in valueCounts.index:  # each item of sampleGroup
-            df = self.expression(key=from_key)[self.samples(key=from_key)[self.samples(key=from_key)[sampleGroup]==item].index]  # expression for this sampleGroup
-            # we need new sample ids based on sample group eg. "Mono1__0"
-            i = 0
-            columns = df.columns.tolist()
-            while len(columns)>sampleSize:
-                selectedColumns = random.sample(columns, sampleSize)
-                aggregated["%s__%s" % (item, i)] = df[selectedColumns].sum(axis=1)
-                samples.at["%s__%s" % (item, i), sampleGroup] = item
-                columns = set(columns).difference(set(selectedColumns))
-                i += 1
-
-        self.annData[to_key] = anndata.AnnData(X=aggregated.transpose(), obs=samples, var=self.annData[from_key].var)
-        return self
+        # Shuffle samples, then order them by group (in order of valueCounts), so that consecutive runs of sampleSize
+        # samples within each group are the members of an aggregated sample. A group of m samples gives (m-1)//sampleSize 
+        # aggregated samples, eg. "Mono1__0", "Mono1__1", ...
+        groups = pandas.Categorical(samples[sampleGroup], categories=valueCounts.index).codes
+        order = numpy.random.default_rng(seed).permutation(numpy.flatnonzero(groups>=0))  # samples without a group are left out
+        order = order[numpy.argsort(groups[order], kind="stable")]
+        counts = valueCounts.values
+        position = numpy.arange(len(order)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)  # position within group
+        blocks = (counts - 1)//sampleSize
+        offsets = numpy.cumsum(blocks) - blocks  # first aggregated sample of each group
+        group = groups[order]
+        selected = position//sampleSize < blocks[group]
+        indicator = sparse.csr_matrix((numpy.ones(selected.sum()), (order[selected], (offsets[group] + position//sampleSize)[selected])), 
+                                      shape=(len(samples), blocks.sum()))
 
+        index = ["%s__%s" % (item, i) for item,count in zip(valueCounts.index, blocks) for i in range(count)]
+        obs = pandas.DataFrame({sampleGroup: numpy.repeat(valueCounts.index.values, blocks).astype(object)}, index=index)
+        X = indicator.transpose().tocsr().dot(self.annData[from_key].X)  # sparse if annData[from_key].X is sparse
+        self.annData[to_key] = anndata.AnnData(X=X, obs=obs, var=self.annData[from_key].var)
+        return self
 
 ################################################################################
 # For testing. Eg: nosetests -s atlas.py:test_atlas
@@ -360,6 +1305,27 @@ def test_atlas():
     assert atl.expression().shape[0] > 3700
     assert len([item for item in atl.expression().columns if '7379' in item])>10
 
+def test_cache():
+    path = "/Users/jarnyc/projects/BloodAtlas/received/Stemformatics"
+    atl = Atlas(path, "blood")  # writes the cache if it is not there yet
+    assert filepaths(path, "blood")["cache"] is not None
+    assert Atlas(path, "blood").expression().equals(atl.expression())
+
+def test_rankTransform():
+    # integer values give plenty of ties, and some NaNs, including a column of all NaN
+    values = numpy.random.RandomState(0).randint(0, 5, size=(50, 7)).astype(float)
+    values[numpy.random.RandomState(1).rand(50, 7)<0.2] = numpy.nan
+    values[:,3] = numpy.nan
+    df = pandas.DataFrame(values)
+    expected = (df.shape[0] - df.rank(axis=0, ascending=False, na_option='bottom') + 1)/df.shape[0]
+    assert numpy.array_equal(rankArray(values), df.rank(axis=0, ascending=False, na_option='bottom').values)
+    assert numpy.allclose(rankTransform(df).values, expected.values, rtol=0, atol=1e-12)
+    assert numpy.allclose(rankArray(values, n_jobs=2, blockSize=2), rankArray(values))
+
+    # RankMatrix stores samples x genes, ie. the transpose
+    ranks = RankMatrix.fromExpression(values.transpose(), blockSize=3)
+    assert numpy.allclose(ranks.decode(dtype=numpy.float64), expected.values.transpose(), rtol=0, atol=1e-12)
+
 def test_addRandom():
     df = pandas.read_csv("/Users/jarnyc/projects/BloodAtlas/received/Galen/GSE116256_RAW/GSM3587996_BM1.dem.txt.gz", 
                          sep="\t", index_col=0, compression='gzip')
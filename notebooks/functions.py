@@ -1,10 +1,13 @@
+import os
 import numpy as np
 import pandas as pd
 import sklearn
 import gc
+import atlas
 import statsmodels.api as sm
-import statsmodels.formula.api as smf
 import sklearn.decomposition
+import scipy.linalg
+import scipy.stats
 from sklearn.cluster import KMeans, AgglomerativeClustering
 
 def transform_to_percentile(dataframe):
@@ -26,12 +29,12 @@ def transform_to_percentile(dataframe):
 
     '''
 
-    transformed_dataframe = (dataframe.shape[0] - dataframe.rank(axis=0, ascending=False, na_option='bottom')+1)/dataframe.shape[0]
+    transformed_dataframe = atlas.rankTransform(dataframe)
 
     return transformed_dataframe
 
 
-def calculate_platform_dependence(data, annotations):
+def calculate_platform_dependence(data, annotations, method='vectorised', n_jobs=1, chunk_size=500, verbose=False, checkpoint_dir=None):
 
     '''
     Calculates the fraction of variance due to platform
@@ -45,6 +48,24 @@ def calculate_platform_dependence(data, annotations):
     annotations
         Dataframe containing metadata, index as samples, requires a column 'Platform_Category'
 
+    method
+        Either 'vectorised' (default), which calculates the fraction for all genes at once from group means and sums
+        of squares, or 'mixedlm', which fits a statsmodels mixed linear model to each gene and is kept as a reference
+
+    n_jobs
+        Number of worker processes used to fit genes when method is 'mixedlm'
+
+    chunk_size
+        Number of genes calculated (or sent to a worker process) at a time
+
+    verbose
+        If True, print progress after each chunk of genes is calculated
+
+    checkpoint_dir
+        If specified, the result of each chunk of genes is saved under this directory as soon as it is calculated,
+        keyed by a hash of data, platforms and settings. A run on the same input then resumes from the chunks already
+        saved, so an interrupted run loses at most one chunk per worker, and a completed run is just read back
+
     Returns:
     ----------
 
@@ -53,25 +74,413 @@ def calculate_platform_dependence(data, annotations):
 
     '''
 
+    if method not in ['vectorised', 'mixedlm']:
+        raise ValueError("method must be either 'vectorised' or 'mixedlm', not '%s'" %method)
+
+    platforms = annotations['Platform_Category'].reindex(data.columns)
+    values    = data.values
+    starts    = list(range(0, values.shape[0], chunk_size))
+    results   = {}
+
+    if checkpoint_dir is not None:
+        checkpoint = os.path.join(checkpoint_dir, platform_dependence_key(data, platforms, method, chunk_size))
+        os.makedirs(checkpoint, exist_ok=True)
+        for start in starts:
+            if os.path.exists(os.path.join(checkpoint, 'genes_%d.npy' %start)):
+                results[start] = np.load(os.path.join(checkpoint, 'genes_%d.npy' %start))
+        if verbose and results:
+            print("Resuming from checkpoint with %d of %d genes done" %(sum(len(chunk) for chunk in results.values()), values.shape[0]))
+
+    todo = [start for start in starts if start not in results]
+
+    if method=='vectorised':
+        n_jobs        = 1
+        fitted_chunks = (variance_fraction(values[start:start+chunk_size], platforms.values) for start in todo)
+
+    else:
+        # Design of "gene ~ Platform_Category" (intercept and treatment coded platforms), built once and shipped once to
+        # each worker. Samples without a platform are dropped, as the formula interface would do.
+        keep      = platforms.notnull().values
+        platforms = platforms[keep].astype(str)
+        design    = np.column_stack([np.ones(len(platforms)), pd.get_dummies(platforms, drop_first=True).values.astype(float)])
+        # Chunks are generated as they are needed, so only those being fitted (or queued for a worker) are copied
+        chunks    = (values[start:start+chunk_size, keep].astype(float) for start in todo)
+
+        if n_jobs==1:
+            init_mixedlm_worker(design, platforms.values)
+            fitted_chunks = map(fit_mixedlm_chunk, chunks)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            executor      = ProcessPoolExecutor(max_workers=n_jobs, initializer=init_mixedlm_worker, initargs=(design, platforms.values))
+            fitted_chunks = bounded_map(executor, fit_mixedlm_chunk, chunks, max_pending=2*n_jobs)
+
+    try:
+        for start, i_chunk in zip(todo, fitted_chunks):
+            results[start] = i_chunk
+            if checkpoint_dir is not None:  # write then rename, so that a killed run never leaves a partial file
+                np.save(os.path.join(checkpoint, 'genes_%d.tmp.npy' %start), i_chunk)
+                os.replace(os.path.join(checkpoint, 'genes_%d.tmp.npy' %start), os.path.join(checkpoint, 'genes_%d.npy' %start))
+            if verbose:
+                print("Fitted %d of %d genes" %(sum(len(chunk) for chunk in results.values()), values.shape[0]))
+    finally:
+        if n_jobs!=1:
+            executor.shutdown()
+
+    return pd.DataFrame(np.concatenate([results[start] for start in starts]) if starts else [], index=data.index, columns=['VarFraction'])
+
+
+def bounded_map(executor, function, iterable, max_pending):
+
+    '''
+    Like executor.map(function, iterable), but takes items from iterable only as results are consumed, so that at most
+    max_pending items are submitted to the executor (and held in memory) at a time. Results are yielded in order
+    '''
+
+    from collections import deque
+
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending)>=max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def platform_dependence_key(data, platforms, method, chunk_size):
+
+    '''
+    Returns a hash of the expression values, gene and sample ids, platforms and settings of a platform dependence run,
+    used to name its checkpoint directory
+    '''
+
+    import hashlib
+
+    key = hashlib.sha1(str(data.shape).encode())
+    for start in range(0, data.shape[0], 1000):  # a block of genes at a time, rather than a copy of all values
+        key.update(np.ascontiguousarray(data.values[start:start+1000], dtype=float).tobytes())
+    for item in [data.index, data.columns, platforms.astype(str), [method, chunk_size]]:
+        key.update(str(list(item)).encode())
+
+    return key.hexdigest()
+
+
+mixedlm_worker = {}
+
+def init_mixedlm_worker(design, groups):
+
+    '''
+    Stores the design matrix and groups used by fit_mixedlm_chunk in this process, so that they are only sent to
+    each worker process once
+    '''
+
     import warnings
     from statsmodels.tools.sm_exceptions import ConvergenceWarning
     warnings.simplefilter('ignore', ConvergenceWarning)
 
-    output_df = pd.DataFrame(index=data.index, columns=['VarFraction'])
+    mixedlm_worker['design'] = design
+    mixedlm_worker['groups'] = groups
+
+
+def fit_mixedlm_chunk(values):
+
+    '''
+    Fits the mixed linear model of calculate_platform_dependence to each row (gene) of values, a numpy array with
+    samples as columns, and returns the fraction of variance due to platform for each row
+    '''
 
-    data = data.copy().transpose().merge(annotations['Platform_Category'], how='left', left_index=True, right_index=True)
+    design, groups = mixedlm_worker['design'], mixedlm_worker['groups']
+    output = np.empty(values.shape[0])
 
-    for i_gene in data.columns.values[:-1]:
+    for i_gene in range(values.shape[0]):
 
-        md  = smf.mixedlm("%s ~ Platform_Category" %str(i_gene), data=data, groups = data['Platform_Category'])
-        mdf = md.fit()
+        sel = ~np.isnan(values[i_gene])
+        mdf = sm.MixedLM(values[i_gene, sel], design[sel], groups=groups[sel]).fit()
 
-        output_df.loc[i_gene, 'VarFraction'] = mdf.fittedvalues.std()**2/(mdf.fittedvalues.std()**2+mdf.resid.std()**2)
+        output[i_gene] = np.var(mdf.fittedvalues, ddof=1)/(np.var(mdf.fittedvalues, ddof=1)+np.var(mdf.resid, ddof=1))
 
-    return output_df
+    return output
 
 
-def resample_clustering(data, annotations, resample_strategy, n_resamples=10, n_clusters_list=[3,4]):
+def variance_fraction(values, labels, block_size=2000):
+
+    '''
+    Calculates the fraction of variance of each gene explained by a categorical variable, ie. between group sum of
+    squares over total sum of squares. The mixed model of calculate_platform_dependence fits the group means, so its
+    VarFraction is the same quantity. NaN values are left out of their gene, and samples without a label are left out.
+
+    Parameters:
+    ----------
+
+    values
+        Numpy array of expression values, genes as rows, samples as columns
+
+    labels
+        Array of group labels of each sample (column of values)
+
+    block_size
+        Number of genes processed at a time, which bounds the memory used for temporary arrays
+
+    Returns:
+    ----------
+
+    fraction
+        Numpy array of the fraction of variance explained by labels for each gene
+
+    '''
+
+    codes, uniques = pd.factorize(labels)
+    indicator = np.zeros((len(codes), len(uniques)))
+    indicator[codes>=0, codes[codes>=0]] = 1
+    values = np.asarray(values, dtype=float)[:, codes>=0]
+    indicator = indicator[codes>=0]
+
+    fraction = np.empty(values.shape[0])
+
+    for start in range(0, values.shape[0], block_size):
+
+        block  = values[start:start+block_size]
+        mask   = ~np.isnan(block)
+        block  = np.where(mask, block, 0)
+
+        counts      = mask @ indicator
+        group_means = np.divide(block @ indicator, counts, out=np.zeros(counts.shape), where=counts>0)
+        means       = block.sum(axis=1)/mask.sum(axis=1)
+
+        total   = (((block - means[:, None])*mask)**2).sum(axis=1)
+        between = (counts*(group_means - means[:, None])**2).sum(axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction[start:start+block_size] = between/total
+
+    return fraction
+
+
+def calculate_variance_partition(data, annotations, factors=['Platform_Category', 'Dataset Name', 'Cell Type'], block_size=2000):
+
+    '''
+    Partitions the variance of each gene between several categorical factors, eg. to tell genes driven by cell type
+    apart from genes driven by platform or dataset. See variance_partition for how the variance is partitioned.
+
+    Parameters:
+    ----------
+
+    data
+        Dataframe containing expression values, index as variables (genes), columns as samples. Must not contain NaNs
+
+    annotations
+        Dataframe containing metadata, index as samples, requires a column for each of factors
+
+    factors
+        List of annotation columns to partition variance over, in order. Shared variance between factors goes to the
+        earlier factor, so list the factors to be removed (such as platform) before the ones to be kept (cell type)
+
+    block_size
+        Number of genes processed at a time
+
+    Returns:
+    ----------
+
+    output_df
+        Dataframe with the fraction of variance of each gene due to each factor, plus a 'Residuals' column
+
+    '''
+
+    labels = [annotations[factor].reindex(data.columns).values for factor in factors]
+    return pd.DataFrame(variance_partition(data.values, labels, block_size=block_size), index=data.index, columns=list(factors)+['Residuals'])
+
+
+def variance_partition(values, labels_list, block_size=2000):
+
+    '''
+    Partitions the variance of each gene between categorical factors with sequential (type I) sums of squares of a
+    linear model, for all genes at once. An orthonormal basis of the centred indicator columns of each factor is built
+    in order, after projecting out the columns of earlier factors, so that the whole decomposition is one matrix product
+    of the basis with the expression values. With a single factor this is the same as variance_fraction.
+    Samples missing a label for any factor are left out.
+
+    Parameters:
+    ----------
+
+    values
+        Numpy array of expression values, genes as rows, samples as columns. Must not contain NaNs
+
+    labels_list
+        List of arrays, each one containing labels of a factor for each sample (column of values)
+
+    block_size
+        Number of genes processed at a time, which bounds the memory used for temporary arrays
+
+    Returns:
+    ----------
+
+    fractions
+        Numpy array of genes x (factors + 1), with the fraction of variance due to each factor and the residual fraction
+
+    '''
+
+    if len(labels_list)==0:
+        raise ValueError("at least one factor is needed to partition variance")
+
+    codes = [pd.factorize(labels)[0] for labels in labels_list]
+    keep  = np.all([code>=0 for code in codes], axis=0)
+
+    values = np.asarray(values, dtype=float)[:, keep]
+    if np.isnan(values).any():
+        raise ValueError("values must not contain NaNs to partition variance")
+
+    # Orthonormal basis for each factor, orthogonal to the intercept and to the basis of earlier factors
+    basis, factor_of_column = np.zeros((keep.sum(), 0)), []
+    for i_factor, code in enumerate(codes):
+        indicator  = np.eye(code.max()+1)[code[keep]]
+        indicator  = indicator - indicator.mean(axis=0)
+        tolerance  = np.linalg.norm(indicator, 2)*max(indicator.shape)*np.finfo(float).eps
+        indicator -= basis @ (basis.T @ indicator)
+        u, singular_values, vt = np.linalg.svd(indicator, full_matrices=False)
+        rank = (singular_values > tolerance).sum()  # columns explained by earlier factors add nothing
+        basis = np.column_stack([basis, u[:, :rank]])
+        factor_of_column += [i_factor]*rank
+
+    factor_matrix = np.zeros((basis.shape[1], len(codes)))
+    factor_matrix[range(basis.shape[1]), factor_of_column] = 1
+
+    fractions = np.empty((values.shape[0], len(codes)+1))
+
+    for start in range(0, values.shape[0], block_size):
+
+        block  = values[start:start+block_size]
+        block  = block - block.mean(axis=1)[:, None]
+        total  = (block**2).sum(axis=1)
+        ss     = ((block @ basis)**2) @ factor_matrix
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fractions[start:start+block_size, :-1] = ss/total[:, None]
+            fractions[start:start+block_size, -1]  = 1 - ss.sum(axis=1)/total
+
+    return fractions
+
+
+def threshold_sweep(data, var_fraction, labels, thresholds=np.round(np.arange(0.04, 1.01, 0.01),2), n_components=10):
+
+    '''
+    For each threshold, runs PCA on the genes with VarFraction below the threshold and calculates the Kruskal-Wallis H
+    statistic of each component between groups of labels (eg. platforms), to help choose the gene filtering threshold.
+
+    Since the gene sets of increasing thresholds are nested, genes are sorted by VarFraction once and the samples x
+    samples Gram matrix of the centred expression values is updated with only the genes added at each threshold.
+    The PCA coordinates are then read off the top eigenvectors of the Gram matrix, rather than fitting a new PCA to
+    a copied subset of the data at every threshold. Coordinates are the same as sklearn's PCA up to sign, and H for
+    all components comes from a single call to kruskal_wallis.
+
+    Parameters:
+    ----------
+
+    data
+        Dataframe containing expression values, index as variables (genes), columns as samples
+
+    var_fraction
+        Series (or Dataframe with a 'VarFraction' column) of the fraction of variance due to platform for each gene,
+        such as the output of calculate_platform_dependence
+
+    labels
+        Series of group labels, index as samples, such as annotations['Platform_Category']
+
+    thresholds
+        Thresholds to sweep over. A gene is used at a threshold if its VarFraction is strictly below it
+
+    n_components
+        Number of principal components to calculate the statistic for
+
+    Returns:
+    ----------
+
+    output_df
+        Dataframe of the H statistic, index as thresholds, columns as components (PC1, PC2, ...). Thresholds with
+        fewer genes than n_components are NaN
+
+    '''
+
+    if isinstance(var_fraction, pd.DataFrame):
+        var_fraction = var_fraction['VarFraction']
+    var_fraction = var_fraction.reindex(data.index).values.astype(float)
+    labels       = labels.reindex(data.columns).values
+
+    order  = np.argsort(var_fraction)  # NaNs are sorted last and never used
+    counts = np.searchsorted(var_fraction[order][~np.isnan(var_fraction[order])], np.sort(thresholds), side='left')
+
+    statistics = np.full((len(counts), n_components), np.nan)
+    values     = data.values
+    gram       = np.zeros((values.shape[1], values.shape[1]))
+    n_genes    = 0
+
+    for i_threshold, count in enumerate(counts):
+
+        if count > n_genes:  # add the new genes to the Gram matrix
+            block    = values[order[n_genes:count]].astype(float)
+            block   -= block.mean(axis=1)[:, None]
+            gram    += block.T @ block
+            n_genes  = count
+
+        if n_genes < n_components:
+            continue
+
+        eigenvalues, eigenvectors = scipy.linalg.eigh(gram, subset_by_index=[gram.shape[0]-n_components, gram.shape[0]-1])
+        coords = eigenvectors[:, ::-1] * np.sqrt(np.clip(eigenvalues[::-1], 0, None))
+
+        statistics[i_threshold] = kruskal_wallis(coords, labels)
+
+    output_df = pd.DataFrame(statistics, index=np.sort(thresholds), columns=['PC%d' %(i+1) for i in range(n_components)])
+
+    return output_df.reindex(thresholds)
+
+
+def kruskal_wallis(values, labels):
+
+    '''
+    Calculates the Kruskal-Wallis H statistic between groups of labels for every column of values at once, the same
+    as calling scipy.stats.kruskal on each column (including its correction for ties). All columns are ranked in a
+    single pass, group rank sums come from one matrix product with a sample x group indicator matrix, and the tie
+    correction uses the sum of squared average ranks, which is N(N+1)(2N+1)/6 - sum(t^3 - t)/12 for tie sizes t.
+
+    Parameters:
+    ----------
+
+    values
+        Numpy array with samples as rows and columns (eg. principal components) to test
+
+    labels
+        Array of group labels for each sample (row of values). Samples without a label are left out
+
+    Returns:
+    ----------
+
+    statistics
+        Numpy array of H for each column of values, NaN where all values of a column are identical
+
+    '''
+
+    codes  = pd.factorize(labels)[0]
+    values = np.asarray(values, dtype=float)[codes>=0]
+    codes  = codes[codes>=0]
+
+    n           = values.shape[0]
+    ranks       = scipy.stats.rankdata(values, axis=0)
+    indicator   = np.eye(codes.max()+1)[codes]
+    rank_sums   = indicator.T @ ranks
+    group_sizes = indicator.sum(axis=0)
+
+    statistics = 12/(n*(n+1)) * (rank_sums**2/group_sizes[:, None]).sum(axis=0) - 3*(n+1)
+    ties       = 12*(n*(n+1)*(2*n+1)/6 - (ranks**2).sum(axis=0))  # sum of t^3 - t over groups of tied values
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        statistics /= 1 - ties/(n**3 - n)
+
+    statistics[np.isinf(statistics)] = np.nan
+
+    return statistics
+
+
+def resample_clustering(data, annotations, resample_strategy, n_resamples=10, n_clusters_list=[3,4], checkpoint_dir=None, method='vectorised', n_jobs=1, random_state=None):
 
     '''
     This cumbersome function performs either jack-knife or bootstrap resampling,
@@ -95,6 +504,17 @@ def resample_clustering(data, annotations, resample_strategy, n_resamples=10, n_
     n_clusters_list
         List of cluster parameters, each value is tested for clustering stability independently
 
+    method, n_jobs
+        Passed onto calculate_platform_dependence
+
+    checkpoint_dir
+        Passed onto calculate_platform_dependence, so that rerunning an interrupted resampling reuses platform
+        dependence results already calculated. For bootstrap resampling, random_state must also be set, so that the
+        rerun draws the same resamples
+
+    random_state
+        Seed for bootstrap resampling, so that results are reproducible
+
     Returns
     ----------
 
@@ -109,7 +529,7 @@ def resample_clustering(data, annotations, resample_strategy, n_resamples=10, n_
 
     # Initial search for platform dependent genes
 
-    base_platform_dependence = calculate_platform_dependence(data, annotations)
+    base_platform_dependence = calculate_platform_dependence(data, annotations, method=method, n_jobs=n_jobs, checkpoint_dir=checkpoint_dir)
 
     base_genes  = base_platform_dependence.index.values[base_platform_dependence.VarFraction.values<=0.145]
     base_data   = transform_to_percentile(data.loc[base_genes].copy())
@@ -125,6 +545,7 @@ def resample_clustering(data, annotations, resample_strategy, n_resamples=10, n_
 
     if resample_strategy=='bootstrap':
         iterations = np.arange(n_resamples)
+        random_state = np.random.RandomState(random_state)
     elif resample_strategy=='jackknife':
         iterations = np.arange(annotations['Dataset'].unique().shape[0])
 
@@ -142,10 +563,10 @@ def resample_clustering(data, annotations, resample_strategy, n_resamples=10, n_
         if resample_strategy=='bootstrap':
 
             print("Bootstrap resampling number %d" %i_iter)
-            i_annotations = annotations.copy().sample(frac=1.0, replace=True)
+            i_annotations = annotations.copy().sample(frac=1.0, replace=True, random_state=random_state)
             i_data        = data[i_annotations.index.values].copy()
 
-        i_varPart  = calculate_platform_dependence(transform_to_percentile(i_data), i_annotations)
+        i_varPart  = calculate_platform_dependence(transform_to_percentile(i_data), i_annotations, method=method, n_jobs=n_jobs, checkpoint_dir=checkpoint_dir)
         i_cut_data = transform_to_percentile(i_data.loc[i_varPart.loc[i_varPart['VarFraction']<=0.145].index.values])
         i_output   = pca.fit_transform(i_cut_data.transpose())
 